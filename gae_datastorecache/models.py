@@ -1,187 +1,446 @@
 import datetime
 import hashlib
-import pickle
 import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 from google.appengine.ext import db
+from google.appengine.runtime.apiproxy_errors import \
+    CapabilityDisabledError, OverQuotaError, RequestTooLargeError
+
+
+_PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+
+_STR_TYPES = (str, unicode)
+
+# Expiration time of items that never expire.
+_NEVER = datetime.datetime(year=datetime.MAXYEAR, month=12, day=31)
+
+# Times up to 31 days in seconds are relative, larger ones are Unix times.
+_MAX_RELATIVE_SECONDS = 2678400
+
+# Errors of failed Datastore calls, which get reported by the return values.
+# CapabilityDisabledError is raised while the Datastore is read-only,
+# RequestTooLargeError for values exceeding the entity size limit and
+# OverQuotaError when the quota is exhausted.
+_DATASTORE_ERRORS = (db.Error, CapabilityDisabledError, OverQuotaError,
+    RequestTooLargeError)
+
+# The maximum number of entities the Datastore accepts in one batch call.
+_MAX_BATCH_SIZE = 500
+
+# Memoized key_names of hashed long keys, mapping (namespace, key) to the
+# key_name. The cache gets cleared when it reaches its maximum size.
+_HASHED_KEY_NAMES = {}
+_HASHED_KEY_NAMES_SIZE = 4096
 
 
 class DatastoreCacheItem(db.Model):
     """
     The DatastoreCacheItem persists the keys and values.
+    The cache key is stored as the key_name of the entity.
     """
-    cache_key = db.StringProperty()
     pickled_value = db.BlobProperty()
+    compressed = db.BooleanProperty(default=False, indexed=False)
     expire_at = db.DateTimeProperty()
 
+    @property
+    def value(self):
+        """
+        The unpickled value, which gets decoded on first access only.
+        """
+        try:
+            return self._unpickled_value
+        except AttributeError:
+            data = self.pickled_value
+            if self.compressed:
+                data = zlib.decompress(data)
+            self._unpickled_value = pickle.loads(data)
+            return self._unpickled_value
 
-class DatastoreCache(object):
+
+class _LegacyDatastoreCacheItem(db.Model):
     """
-    The API to use a datastore backed cache.
+    DatastoreCacheItem entities as stored by earlier versions, with an
+    automatic id and the cache key in the cache_key property.
+    Only used by migrate_legacy_items.
     """
+    cache_key = db.StringProperty()
+    pickled_value = db.BlobProperty()
+    expire_at = db.DateTimeProperty()
 
     @classmethod
-    def _parse_key(self, key):
-        """
-        Parses and returns the key as a string.
-        The key can be a string or a tuple of (hash_value, string)
-        """
-        if isinstance(key, tuple) and len(key) >= 2:
-            key = key[1]
-        if isinstance(key, (str, unicode, )):
-            return key
-        raise TypeError('Key must be a string or a tuple with the key as '\
-            'second item')
+    def kind(cls):
+        return DatastoreCacheItem.kind()
 
-    @classmethod
-    def _parse_time(self, time):
-        """
-        Parses and returns the time as a datatime.datetime instance.
-        Time must be either relative number of seconds from current time (up
-        to 1 month), or an absolute Unix epoch time.
-        """
-        if not isinstance(time, (int, long, float)):
-            raise TypeError('Time must either be a relative number of '\
-                'seconds from current time (up to 1 month), or an absolute '\
-                'Unix epoch time')
-        if time == 0:
-            dt = datetime.datetime(year=datetime.MAXYEAR, month=12, day=31)
-        elif time <= 2678400:  # 31 days in seconds
-            dt = datetime.datetime.now() + datetime.timedelta(seconds=time)
-        else:
-            dt = datetime.datetime.fromtimestamp(time)
 
-        return dt
+def _parse_key(key):
+    """
+    Parses and returns the key as a string.
+    The key can be a string or a tuple of (hash_value, string)
+    """
+    if isinstance(key, _STR_TYPES):
+        return key
+    if isinstance(key, tuple) and len(key) >= 2 and \
+        isinstance(key[1], _STR_TYPES):
+        return key[1]
+    raise TypeError('Key must be a string or a tuple with the key as '\
+        'second item')
 
-    @classmethod
-    def _get_key_name(self, key, namespace=None):
-        """
-        Returns the key_name including the namespace.
-        If the key is longer than 250 characters, the key gets hashed.
-        """
-        key = self._parse_key(key)
-        key_name = ''.join([namespace or '', key])
-        if len(key_name) > 250:
-            m = hashlib.sha256()
-            m.update(key)
-            key_name = ''.join([namespace or '', m.hexdigest()])
+
+def _parse_time(time, now=None):
+    """
+    Parses and returns the time as a datatime.datetime instance.
+    Time must be either relative number of seconds from current time (up
+    to 1 month), or an absolute Unix epoch time.
+    The current time can be passed as now, to not look it up again.
+    """
+    if not isinstance(time, (int, long, float)):
+        raise TypeError('Time must either be a relative number of '\
+            'seconds from current time (up to 1 month), or an absolute '\
+            'Unix epoch time')
+    if time == 0:
+        dt = _NEVER
+    elif time <= _MAX_RELATIVE_SECONDS:
+        if now is None:
+            now = datetime.datetime.now()
+        dt = now + datetime.timedelta(seconds=time)
+    else:
+        dt = datetime.datetime.fromtimestamp(time)
+
+    return dt
+
+
+def _get_key_name(key, namespace=None):
+    """
+    Returns the key_name including the namespace.
+    If the key is longer than 250 characters, the key gets hashed.
+    Hashed key_names are memoized, so repeated access to the same long
+    key only hashes it once.
+    """
+    key = _parse_key(key)
+    prefix = namespace or ''
+    key_name = prefix + key
+    if len(key_name) > 250:
+        try:
+            return _HASHED_KEY_NAMES[(namespace, key)]
+        except KeyError:
+            pass
+        # The hash only shortens the key_name, so the faster md5 will do.
+        m = hashlib.md5()
+        m.update(key)
+        key_name = _escape_key_name(prefix + m.hexdigest())
+        if len(_HASHED_KEY_NAMES) >= _HASHED_KEY_NAMES_SIZE:
+            _HASHED_KEY_NAMES.clear()
+        _HASHED_KEY_NAMES[(namespace, key)] = key_name
         return key_name
+    return _escape_key_name(key_name)
 
-    @classmethod
-    def _get_item(self, key, namespace=None, delete_expired=True):
-        """
-        Returns the matching and not expired item or None.
-        When the delete_expired parameter is set to True, matching but
-        expired items get deleted transparently.
-        """
-        key_name = self._get_key_name(key, namespace)
 
-        item = DatastoreCacheItem.all().filter('cache_key =',
-            key_name).get()
-        if item is not None:
-            if item.expire_at >= datetime.datetime.now():
-                return item
-            elif delete_expired:
-                item.delete()
-        return None
+def _escape_key_name(key_name):
+    """
+    Returns the key_name in a form the Datastore accepts.
+    Empty key_names and the reserved ones starting with '__' get prefixed
+    with '!'. So do key_names already starting with '!', to keep all of
+    them unique.
+    """
+    if not key_name or key_name.startswith(('__', '!')):
+        return '!' + key_name
+    return key_name
 
-    @classmethod
-    def set(self, key, value, time=0, min_compress_len=0, namespace=None):
-        """
-        Sets a key's value, regardless of previous contents in cache.
-        The return value is True if set, False on error.
-        """
-        key_name = self._get_key_name(key, namespace)
-        time = self._parse_time(time)
 
-        old_valid_item = self._get_item(key, namespace, delete_expired=True)
-        if old_valid_item is not None:
-            item = old_valid_item
-        else:
-            item = DatastoreCacheItem(cache_key=key_name)
+def _dump_value(value, min_compress_len=0):
+    """
+    Pickles the value and returns a tuple of (blob, compressed).
+    When min_compress_len is set and the pickled value is at least that
+    long, it gets compressed with zlib.
+    """
+    data = pickle.dumps(value, _PICKLE_PROTOCOL)
+    if min_compress_len and len(data) >= min_compress_len:
+        return db.Blob(zlib.compress(data, 1)), True
+    return db.Blob(data), False
 
-        item.expire_at = time
-        item.pickled_value = db.Blob(pickle.dumps(value, 1))
 
-        try:
-            item.put()
-        except:
-            return False
-        else:
-            return True
+def _get_item(key, namespace=None, delete_expired=True):
+    """
+    Returns the matching and not expired item or None.
+    When the delete_expired parameter is set to True, matching but
+    expired items get deleted transparently.
+    """
+    key_name = _get_key_name(key, namespace)
 
-    @classmethod
-    def get(self, key, namespace=None, delete_expired=True):
-        """
-        Returns the value of the key, if found in cache, else None.
-        """
-        item = self._get_item(key, namespace=namespace,
-            delete_expired=delete_expired)
-        if item is not None:
-            return pickle.loads(item.pickled_value)
+    item = DatastoreCacheItem.get_by_key_name(key_name)
+    if item is not None:
+        if item.expire_at >= datetime.datetime.now():
+            return item
+        elif delete_expired:
+            item.delete()
+    return None
 
-        return None
 
-    @classmethod
-    def delete(self, key, seconds=0, namespace=None):
-        """
-        Deletes a key from cache.
+def _delete_all(query):
+    """
+    Deletes all items matched by the keys-only query in batches of 100.
+    The query is built once and continued by its cursor.
+    The return value is True on success, False on error.
+    """
+    try:
+        keys = query.fetch(100)
+        while keys:
+            db.delete(keys)
+            keys = query.with_cursor(query.cursor()).fetch(100)
+    except _DATASTORE_ERRORS:
+        return False
+    else:
+        return True
 
-        Parameter seconds: Ignored option for compatibility.
-        The return value is 0 (DELETE_NETWORK_FAILURE) on network failure,
-        1 (DELETE_ITEM_MISSING) if the server tried to delete the item but
-        didn't have it, and 2 (DELETE_SUCCESSFUL) if the item was actually
-        deleted.
-        """
-        item = self._get_item(key, namespace=namespace)
-        if item is not None:
-            try:
-                item.delete()
-            except:
-                return 0
-            else:
-                return 2
 
-        return 1
+def _set_if(key, value, time=0, min_compress_len=0, namespace=None,
+    in_cache=False):
+    """
+    Sets a key's value, if and only if the key is in cache (in_cache is
+    True) or not in cache (in_cache is False).
+    The lookup and the put run in a single transaction.
+    The return value is True if set, False on error or mismatch.
+    """
+    key_name = _get_key_name(key, namespace)
+    now = datetime.datetime.now()
+    time = _parse_time(time, now=now)
+    pickled_value, compressed = _dump_value(value, min_compress_len)
 
-    @classmethod
-    def add(self, key, value, time=0, min_compress_len=0, namespace=None):
-        """
-        Sets a key's value, if and only if the item is not already in cache.
-        The return value is True if added, False on error.
-        """
-        item = self._get_item(key, namespace=namespace)
-        if item is None:
-            return self.set(key, value, time=time,
-                min_compress_len=min_compress_len, namespace=namespace)
+    def txn():
+        item = DatastoreCacheItem.get_by_key_name(key_name)
+        is_cached = item is not None and item.expire_at >= now
+        if is_cached != in_cache:
+            return False
+        DatastoreCacheItem(key_name=key_name, expire_at=time,
+            pickled_value=pickled_value, compressed=compressed).put()
+        return True
+
+    try:
+        return db.run_in_transaction(txn)
+    except _DATASTORE_ERRORS:
         return False
 
-    @classmethod
-    def replace(self, key, value, time=0, min_compress_len=0, namespace=None):
-        """
-        Replaces a key's value, failing if item isn't already in cache.
-        The return value is True if replaced. False on error or cache miss.
-        """
-        item = self._get_item(key, namespace=namespace)
-        if item is not None:
-            return self.set(key, value, time=time,
-                min_compress_len=min_compress_len, namespace=namespace)
 
+def set(key, value, time=0, min_compress_len=0, namespace=None):
+    """
+    Sets a key's value, regardless of previous contents in cache.
+    The return value is True if set, False on error.
+    """
+    key_name = _get_key_name(key, namespace)
+    time = _parse_time(time)
+
+    pickled_value, compressed = _dump_value(value, min_compress_len)
+
+    # The key_name is unique, so putting a new entity overwrites any
+    # previous (valid or expired) item without reading it first.
+    item = DatastoreCacheItem(key_name=key_name, expire_at=time,
+        pickled_value=pickled_value, compressed=compressed)
+
+    try:
+        item.put()
+    except _DATASTORE_ERRORS:
         return False
+    else:
+        return True
 
-    @classmethod
-    def flush_all(self):
-        """
-        Deletes all items in cache.
-        The return value is True on success, False on error.
-        """
+
+def get(key, namespace=None, delete_expired=True):
+    """
+    Returns the value of the key, if found in cache, else None.
+    """
+    item = _get_item(key, namespace=namespace,
+        delete_expired=delete_expired)
+    if item is not None:
+        return item.value
+
+    return None
+
+
+def get_multi(keys, namespace=None, delete_expired=True):
+    """
+    Looks up multiple keys from cache in batches of _MAX_BATCH_SIZE.
+    The return value is a dictionary of the keys found in cache and
+    their values.
+    """
+    keys = list(keys)
+    key_names = [_get_key_name(key, namespace) for key in keys]
+    items = []
+    for i in xrange(0, len(key_names), _MAX_BATCH_SIZE):
+        items.extend(DatastoreCacheItem.get_by_key_name(
+            key_names[i:i + _MAX_BATCH_SIZE]))
+
+    now = datetime.datetime.now()
+    values = {}
+    expired_items = []
+    for key, item in zip(keys, items):
+        if item is None:
+            continue
+        if item.expire_at >= now:
+            values[key] = item.value
+        elif delete_expired:
+            expired_items.append(item)
+    if expired_items:
+        # Failing to clean up must not fail the lookup itself.
+        for i in xrange(0, len(expired_items), _MAX_BATCH_SIZE):
+            try:
+                db.delete(expired_items[i:i + _MAX_BATCH_SIZE])
+            except _DATASTORE_ERRORS:
+                pass
+
+    return values
+
+
+def set_multi(mapping, time=0, min_compress_len=0, namespace=None):
+    """
+    Sets multiple keys' values at once, regardless of previous contents
+    in cache.
+    The items get put in batches of _MAX_BATCH_SIZE.
+    The return value is a list of keys whose values were NOT set, which
+    is empty on success.
+    """
+    time = _parse_time(time)
+
+    keys = []
+    items = []
+    for key, value in mapping.iteritems():
+        key_name = _get_key_name(key, namespace)
+        pickled_value, compressed = _dump_value(value,
+            min_compress_len)
+        keys.append(key)
+        items.append(DatastoreCacheItem(key_name=key_name, expire_at=time,
+            pickled_value=pickled_value, compressed=compressed))
+
+    failed_keys = []
+    for i in xrange(0, len(items), _MAX_BATCH_SIZE):
         try:
-            entities = DatastoreCacheItem.all().fetch(100)
-            while entities:
-                db.delete(entities)
-                entities = DatastoreCacheItem.all().filter('__key__ >',
-                    entities[-1].key()).fetch(100)
-        except:
-            return False
+            db.put(items[i:i + _MAX_BATCH_SIZE])
+        except _DATASTORE_ERRORS:
+            failed_keys.extend(keys[i:i + _MAX_BATCH_SIZE])
+    return failed_keys
+
+
+def delete(key, seconds=0, namespace=None):
+    """
+    Deletes a key from cache.
+
+    Parameter seconds: Ignored option for compatibility.
+    The return value is 0 (DELETE_NETWORK_FAILURE) on network failure,
+    1 (DELETE_ITEM_MISSING) if the server tried to delete the item but
+    didn't have it, and 2 (DELETE_SUCCESSFUL) if the item was actually
+    deleted.
+    """
+    item = _get_item(key, namespace=namespace)
+    if item is not None:
+        try:
+            item.delete()
+        except _DATASTORE_ERRORS:
+            return 0
         else:
-            return True
+            return 2
+
+    return 1
+
+
+def add(key, value, time=0, min_compress_len=0, namespace=None):
+    """
+    Sets a key's value, if and only if the item is not already in cache.
+    The return value is True if added, False on error.
+    """
+    return _set_if(key, value, time=time,
+        min_compress_len=min_compress_len, namespace=namespace,
+        in_cache=False)
+
+
+def replace(key, value, time=0, min_compress_len=0, namespace=None):
+    """
+    Replaces a key's value, failing if item isn't already in cache.
+    The return value is True if replaced. False on error or cache miss.
+    """
+    return _set_if(key, value, time=time,
+        min_compress_len=min_compress_len, namespace=namespace,
+        in_cache=True)
+
+
+def flush_all():
+    """
+    Deletes all items in cache.
+    The return value is True on success, False on error.
+    """
+    return _delete_all(DatastoreCacheItem.all(keys_only=True))
+
+
+def flush_expired():
+    """
+    Deletes all expired items in cache.
+    The Datastore selects the expired items by their expire_at index,
+    so neither expired nor valid values get transferred.
+    The return value is True on success, False on error.
+    """
+    return _delete_all(DatastoreCacheItem.all(keys_only=True).filter(
+        'expire_at <', datetime.datetime.now()))
+
+
+def migrate_legacy_items():
+    """
+    Re-keys items stored by earlier versions, which had an automatic id and
+    the cache key in the cache_key property, under their key_name.
+    Expired legacy items get deleted, as do legacy items whose key is
+    already in cache with a newer value.
+    Run it once after upgrading, until then legacy items are not found.
+    The return value is True on success, False on error.
+    """
+    try:
+        query = _LegacyDatastoreCacheItem.all()
+        legacy_items = query.fetch(100)
+        while legacy_items:
+            now = datetime.datetime.now()
+            legacy_items = [item for item in legacy_items
+                if item.key().name() is None]
+            valid_items = [item for item in legacy_items
+                if item.expire_at >= now]
+            key_names = [_escape_key_name(item.cache_key or '')
+                for item in valid_items]
+            current_items = DatastoreCacheItem.get_by_key_name(key_names)
+            db.put([DatastoreCacheItem(key_name=key_name,
+                    expire_at=item.expire_at,
+                    pickled_value=item.pickled_value)
+                for key_name, item, current_item
+                in zip(key_names, valid_items, current_items)
+                if current_item is None])
+            db.delete(legacy_items)
+            legacy_items = query.with_cursor(query.cursor()).fetch(100)
+    except _DATASTORE_ERRORS:
+        return False
+    else:
+        return True
+
+
+class DatastoreCache(object):
+    """
+    The API to use a datastore backed cache.
+    Kept for compatibility, the methods are the module level functions.
+    """
+    _parse_key = staticmethod(_parse_key)
+    _parse_time = staticmethod(_parse_time)
+    _get_key_name = staticmethod(_get_key_name)
+    _escape_key_name = staticmethod(_escape_key_name)
+    _dump_value = staticmethod(_dump_value)
+    _get_item = staticmethod(_get_item)
+    _delete_all = staticmethod(_delete_all)
+    _set_if = staticmethod(_set_if)
+    set = staticmethod(set)
+    get = staticmethod(get)
+    get_multi = staticmethod(get_multi)
+    set_multi = staticmethod(set_multi)
+    delete = staticmethod(delete)
+    add = staticmethod(add)
+    replace = staticmethod(replace)
+    flush_all = staticmethod(flush_all)
+    flush_expired = staticmethod(flush_expired)
+    migrate_legacy_items = staticmethod(migrate_legacy_items)
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 import datetime
+import pickle
 import random
 import time
 import unittest
 
 from gae_datastorecache.models import DatastoreCache as Cache
 from gae_datastorecache.models import DatastoreCacheItem as Item
+from gae_datastorecache.models import _HASHED_KEY_NAMES, _MAX_BATCH_SIZE
+from gae_datastorecache.models import _LegacyDatastoreCacheItem as LegacyItem
 from google.appengine.ext import db
+from google.appengine.runtime.apiproxy_errors import \
+    CapabilityDisabledError, RequestTooLargeError
 
 
 class DatastoreCacheParseKeyTests(unittest.TestCase):
@@ -64,7 +69,7 @@ class DatastoreCacheGetKeyNameTests(unittest.TestCase):
     def test_long_without_namespace(self):
         key = 'a' * 300
         key_name = Cache._get_key_name(key)
-        hash_length = 64
+        hash_length = 32
 
         self.assertNotEquals(key_name, key)
         self.assertEquals(len(key_name), hash_length)
@@ -79,13 +84,32 @@ class DatastoreCacheGetKeyNameTests(unittest.TestCase):
     def test_long_with_namespace(self):
         key = 'a' * 300
         namespace = 'prefix'
-        hash_length = 64
+        hash_length = 32
 
         key_name = Cache._get_key_name(key, namespace=namespace)
         self.assertNotEquals(key_name, ''.join([namespace, key]))
         self.assertTrue(key_name.startswith(namespace))
         self.assertEquals(len(key_name), sum([len(namespace), hash_length]))
 
+    def test_empty_key(self):
+        self.assertEquals(Cache._get_key_name(''), '!')
+
+    def test_reserved_key(self):
+        self.assertEquals(Cache._get_key_name('__key__'), '!__key__')
+
+    def test_escaped_keys_stay_unique(self):
+        self.assertEquals(Cache._get_key_name('!'), '!!')
+        self.assertEquals(Cache._get_key_name('!__key__'), '!!__key__')
+
+    def test_long_key_name_is_memoized(self):
+        key = 'b' * 300
+        namespace = 'prefix'
+
+        key_name = Cache._get_key_name(key, namespace=namespace)
+        self.assertEquals(_HASHED_KEY_NAMES[(namespace, key)], key_name)
+        self.assertEquals(Cache._get_key_name(key, namespace=namespace),
+            key_name)
+
 
 class DatastoreCachePublicMethodsTests(unittest.TestCase):
 
@@ -94,8 +118,17 @@ class DatastoreCachePublicMethodsTests(unittest.TestCase):
         self.namespace = 'prefix'
         self.value = 'what about german characters like ä ü ö and ß?'
 
-    def raise_exception(self):
-        raise Exception()
+    def raise_exception(self, *args, **kwargs):
+        raise db.Timeout()
+
+    def raise_error(self, error):
+        def stub(*args, **kwargs):
+            raise error()
+        return stub
+
+    def patch(self, obj, name, replacement):
+        self.addCleanup(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, replacement)
 
     def test_set_and_get_with_expiration(self):
         self.assertTrue(Cache.set(self.key, self.value, time=1,
@@ -105,11 +138,54 @@ class DatastoreCachePublicMethodsTests(unittest.TestCase):
         time.sleep(1)
         self.assertFalse(Cache.get(self.key, namespace=self.namespace))
 
+    def test_set_and_get_with_empty_and_reserved_keys(self):
+        for key in ['', '__key__', '!']:
+            self.assertTrue(Cache.set(key, key))
+        for key in ['', '__key__', '!']:
+            self.assertEquals(Cache.get(key), key)
+        self.assertEquals(Cache.get_multi(['', '__key__']),
+            {'': '', '__key__': '__key__'})
+
+    def test_set_and_get_with_compression(self):
+        value = self.value * 100
+        self.assertTrue(Cache.set(self.key, value, min_compress_len=100))
+        self.assertTrue(Item.get_by_key_name(self.key).compressed)
+        self.assertEquals(Cache.get(self.key), value)
+
+    def test_set_below_min_compress_len(self):
+        self.assertTrue(Cache.set(self.key, self.value,
+            min_compress_len=100000))
+        self.assertFalse(Item.get_by_key_name(self.key).compressed)
+        self.assertEquals(Cache.get(self.key), self.value)
+
+    def test_item_value_is_unpickled_once(self):
+        self.assertTrue(Cache.set(self.key, [self.value]))
+        item = Item.get_by_key_name(self.key)
+        self.assertEquals(item.value, [self.value])
+        self.assertTrue(item.value is item.value)
+
     def test_set_when_put_fails(self):
-        _original_put = Item.put
-        Item.put = self.raise_exception
+        self.patch(Item, 'put', self.raise_exception)
+        self.assertFalse(Cache.set(self.key, self.value))
+
+    def test_set_when_put_is_rejected(self):
+        self.patch(Item, 'put', self.raise_error(db.BadRequestError))
         self.assertFalse(Cache.set(self.key, self.value))
-        Item.put = _original_put
+
+    def test_set_when_value_is_too_large(self):
+        self.patch(Item, 'put', self.raise_error(RequestTooLargeError))
+        self.assertFalse(Cache.set(self.key, self.value))
+
+    def test_set_and_add_when_datastore_is_read_only(self):
+        self.patch(Item, 'put', self.raise_error(CapabilityDisabledError))
+        self.assertFalse(Cache.set(self.key, self.value))
+        self.patch(db, 'run_in_transaction',
+            self.raise_error(CapabilityDisabledError))
+        self.assertFalse(Cache.add(self.key, self.value))
+
+    def test_set_multi_when_datastore_is_read_only(self):
+        self.patch(db, 'put', self.raise_error(CapabilityDisabledError))
+        self.assertEquals(Cache.set_multi({'1': 1}), ['1'])
 
     def test_get_with_delete_expired(self):
         millenium_unixtime = 946706400
@@ -118,45 +194,136 @@ class DatastoreCachePublicMethodsTests(unittest.TestCase):
         self.assertTrue(Cache.set(self.key, self.value,
             time=millenium_unixtime))
         # Check if it exists in the Datastore
-        self.assertTrue(Item.all().filter('cache_key =', self.key).get())
+        self.assertTrue(Item.get_by_key_name(self.key))
         # Try to get it should return None, but force to keep the item
         self.assertEquals(Cache.get(self.key, delete_expired=False), None)
         # Check again if it exists in the Datastore
-        self.assertTrue(Item.all().filter('cache_key =', self.key).get())
+        self.assertTrue(Item.get_by_key_name(self.key))
         # Try to get it should return None and delete the item
         self.assertEquals(Cache.get(self.key), None)
         # Check again if it exists in the Datastore, it should have been del.
-        self.assertFalse(Item.all().filter('cache_key =', self.key).get())
+        self.assertFalse(Item.get_by_key_name(self.key))
+
+    def test_set_multi_and_get_multi(self):
+        mapping = {'1': self.value, ('hash', '2'): 'other value'}
+        self.assertEquals(Cache.set_multi(mapping, namespace=self.namespace),
+            [])
+        self.assertEquals(Cache.get_multi(['1', ('hash', '2'), '3'],
+            namespace=self.namespace), mapping)
+
+    def test_set_multi_when_put_fails(self):
+        self.patch(db, 'put', self.raise_exception)
+        self.assertEquals(sorted(Cache.set_multi({'1': 1, '2': 2})),
+            ['1', '2'])
+
+    def test_set_multi_puts_in_batches(self):
+        batch_sizes = []
+        _original_put = db.put
+
+        def put(items):
+            batch_sizes.append(len(items))
+            if len(batch_sizes) > 1:
+                raise db.Timeout()
+            return _original_put(items)
+
+        self.patch(db, 'put', put)
+        mapping = dict(('batch%d' % i, i) for i in range(_MAX_BATCH_SIZE + 1))
+        failed_keys = Cache.set_multi(mapping)
+
+        self.assertEquals(batch_sizes, [_MAX_BATCH_SIZE, 1])
+        self.assertEquals(len(failed_keys), 1)
+        self.assertEquals(Cache.get(failed_keys[0]), None)
+
+    def test_get_multi_with_delete_expired(self):
+        millenium_unixtime = 946706400
+
+        self.assertEquals(Cache.set_multi({'1': self.value},
+            time=millenium_unixtime), [])
+        self.assertEquals(Cache.get_multi(['1'], delete_expired=False), {})
+        self.assertTrue(Item.get_by_key_name('1'))
+        self.assertEquals(Cache.get_multi(['1']), {})
+        self.assertFalse(Item.get_by_key_name('1'))
+
+    def test_get_multi_gets_and_deletes_in_batches(self):
+        millenium_unixtime = 946706400
+        keys = ['batch%d' % i for i in range(_MAX_BATCH_SIZE + 1)]
+        self.assertEquals(Cache.set_multi(dict.fromkeys(keys, self.value),
+            time=millenium_unixtime), [])
+
+        get_sizes = []
+        delete_sizes = []
+        _original_get_by_key_name = Item.get_by_key_name
+        _original_delete = db.delete
+
+        def get_by_key_name(key_names):
+            get_sizes.append(len(key_names))
+            return _original_get_by_key_name(key_names)
+
+        def delete(items):
+            delete_sizes.append(len(items))
+            return _original_delete(items)
+
+        self.patch(Item, 'get_by_key_name', staticmethod(get_by_key_name))
+        self.patch(db, 'delete', delete)
+        self.assertEquals(Cache.get_multi(keys), {})
+        self.assertEquals(get_sizes, [_MAX_BATCH_SIZE, 1])
+        self.assertEquals(delete_sizes, [_MAX_BATCH_SIZE, 1])
+
+    def test_get_multi_with_generator(self):
+        self.assertEquals(Cache.set_multi({'1': self.value}), [])
+        self.assertEquals(Cache.get_multi(key for key in ['1']),
+            {'1': self.value})
+
+    def test_get_multi_when_deleting_expired_fails(self):
+        millenium_unixtime = 946706400
+
+        self.assertTrue(Cache.set('1', self.value))
+        self.assertTrue(Cache.set('2', self.value, time=millenium_unixtime))
+
+        self.patch(db, 'delete', self.raise_exception)
+        self.assertEquals(Cache.get_multi(['1', '2']), {'1': self.value})
 
     def test_delete_for_non_available_key(self):
         key = 'nonexistingkey%s' % str(random.random())
         self.assertEquals(Cache.delete(key), 1)
 
     def test_delete_existing_key_with_network_problem(self):
-        _original_delete = Item.delete
-        Item.delete = self.raise_exception
+        self.patch(Item, 'delete', self.raise_exception)
 
         self.assertTrue(Cache.set(self.key, self.value))
         self.assertEquals(Cache.delete(self.key), 0)
 
-        Item.delete = _original_delete
-
     def test_delete_existing_key(self):
         self.assertTrue(Cache.set(self.key, self.value))
         self.assertEquals(Cache.delete(self.key), 2)
 
     def test_add(self):
-        key = 'nonexistingkey%s' % str(random.random())
         # Non existing key gets added
         self.assertTrue(Cache.add(self.key, self.value))
         # Existing key cannot get added
         self.assertFalse(Cache.add(self.key, self.value))
 
+    def test_add_over_expired_item(self):
+        millenium_unixtime = 946706400
+
+        self.assertTrue(Cache.set(self.key, self.value,
+            time=millenium_unixtime))
+        self.assertTrue(Cache.add(self.key, 'new value'))
+        self.assertEquals(Cache.get(self.key), 'new value')
+
     def test_replace(self):
         self.assertFalse(Cache.replace(self.key, self.value))
         self.assertTrue(Cache.set(self.key, self.value))
         self.assertTrue(Cache.replace(self.key, 'new value'))
 
+    def test_replace_expired_item(self):
+        millenium_unixtime = 946706400
+
+        self.assertTrue(Cache.set(self.key, self.value,
+            time=millenium_unixtime))
+        self.assertFalse(Cache.replace(self.key, 'new value'))
+        self.assertEquals(Item.get_by_key_name(self.key).value, self.value)
+
     def test_flush_all(self):
         self.assertTrue(Cache.set('1', self.value))
         self.assertTrue(Cache.set('2', self.value))
@@ -164,11 +331,37 @@ class DatastoreCachePublicMethodsTests(unittest.TestCase):
         self.assertFalse(Item.all().count())
 
     def test_flush_all_but_db_delete_fails(self):
-        _original_delete = db.delete
-        db.delete = self.raise_exception
-
         self.assertTrue(Cache.set('1', self.value))
         self.assertTrue(Cache.set('2', self.value))
+
+        self.patch(db, 'delete', self.raise_exception)
         self.assertFalse(Cache.flush_all())
 
-        db.delete = _original_delete
+    def test_flush_expired(self):
+        millenium_unixtime = 946706400
+
+        self.assertTrue(Cache.set('1', self.value, time=millenium_unixtime))
+        self.assertTrue(Cache.set('2', self.value))
+        self.assertTrue(Cache.flush_expired())
+        self.assertFalse(Item.get_by_key_name('1'))
+        self.assertTrue(Item.get_by_key_name('2'))
+
+    def test_migrate_legacy_items(self):
+        millenium_unixtime = 946706400
+        valid = LegacyItem(cache_key='legacy', expire_at=Cache._parse_time(0),
+            pickled_value=db.Blob(pickle.dumps(self.value, 1)))
+        expired = LegacyItem(cache_key='expired',
+            expire_at=Cache._parse_time(millenium_unixtime),
+            pickled_value=db.Blob(pickle.dumps(self.value, 1)))
+        newer = LegacyItem(cache_key='newer', expire_at=Cache._parse_time(0),
+            pickled_value=db.Blob(pickle.dumps(self.value, 1)))
+        db.put([valid, expired, newer])
+        self.assertTrue(Cache.set('newer', 'new value'))
+        self.assertEquals(Cache.get('legacy'), None)
+
+        self.assertTrue(Cache.migrate_legacy_items())
+        self.assertEquals(Cache.get('legacy'), self.value)
+        self.assertEquals(Cache.get('newer'), 'new value')
+        self.assertFalse(Item.get_by_key_name('expired'))
+        self.assertEquals(LegacyItem.get_by_id([valid.key().id(),
+            expired.key().id(), newer.key().id()]), [None, None, None])